@@ -29,17 +29,18 @@ import logging
 import asyncio
 from discord import File
 from select import select
-from .enums import FilterStatus
+from .enums import AudioSink, FilterStatus
 from .errors import AlreadyRecording, NotRecording
 from .opus import OpusStruct, Xsalsa20Decrypt, DecodeManager
 from typing import (
     TYPE_CHECKING,
+    Callable,
     Dict,
     Generic,
+    List,
     Optional,
     TypeVar,
     Union,
-    Any,
 )
 
 
@@ -53,6 +54,18 @@ __all__ = ("UserFilter",)
 
 _log = logging.getLogger(__name__)
 
+_RTP_HEADER = struct.Struct(">xxHII")
+_SILENCE_SAMPLE = bytes(2)  # A single zeroed signed 16-bit PCM sample.
+_SILENCE_FRAME_SIZE = 3  # Length of the b"\xf8\xff\xfe" opus silence frame.
+
+# Bytes each encryption mode adds to the opus payload: the poly1305 MAC
+# plus the nonce appended to the packet, if any.
+_ENCRYPTION_OVERHEAD = {
+    "xsalsa20_poly1305": 16,
+    "xsalsa20_poly1305_suffix": 16 + 24,
+    "xsalsa20_poly1305_lite": 16 + 4,
+}
+
 T = TypeVar("T")
 SinkT = TypeVar("SinkT", bound="BaseSink", covariant=True)
 
@@ -85,12 +98,29 @@ class UserFilter(Generic[T]):
         self.voice_client: VoiceClient = voice_client
         self.voice_websocket: DiscordVoiceWebSocket = voice_client.ws
 
-        self._user_audio_data: Dict[Snowflake, io.BytesIO] = {}
+        self._user_audio_data: Dict[Snowflake, List[bytes]] = {}
         self._user_audio_files: Dict[Snowflake, io.BytesIO]
-        self._user_audio_timestamp: Dict[Any, Any] = {}
+        self._user_audio_timestamp: Dict[int, int] = {}
+        # Audio of speakers whose SSRC has not been announced yet, and the
+        # tasks waiting for that announcement.
+        self._pending_audio: Dict[int, List[bytes]] = {}
+        self._ssrc_waiters: Dict[int, asyncio.Task] = {}
         self._decoder: Optional[DecodeManager] = None
+        self._decrypt_fn: Optional[Callable[[memoryview, memoryview], bytes]] = None
+        self._silence_packet_size: int = 0
         self._sink: Optional[SinkT] = None
         self._record_time: float = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop_task: Optional[asyncio.Task[RecordFileTree]] = None
+        # The socket's fd is kept so the reader can be removed after the
+        # voice client has closed the socket.
+        self._socket_fd: int = -1
+        # Only used where the event loop has no add_reader, e.g. on Windows.
+        self._recv_task: Optional[asyncio.Task] = None
+        # Packets are received into one reusable buffer; only those that are
+        # queued for decoding get copied out of it.
+        self._recv_buffer: bytearray = bytearray(4096)
+        self._recv_view: memoryview = memoryview(self._recv_buffer)
         self._recoding: bool = False
         self._paused: bool = False
 
@@ -120,12 +150,21 @@ class UserFilter(Generic[T]):
         ------
         NotRecording
             You cannot use toggle_pause function to the filter because they are not recording
+            or the recording is being stopped.
         """
 
-        if not self._recoding:
+        if not self._recoding or self._stop_task is not None:
             raise NotRecording("Not currently recording audio.")
         self._paused = not self._paused
 
+        # Stop watching the socket while paused so no packets are read at all.
+        if self._paused:
+            self._stop_receiving()
+        else:
+            # Discard whatever arrived while paused before receiving again.
+            self._empty_socket()
+            self._start_receiving()
+
     def add_user(self, user: Union[User, Member], /) -> None:
         """Add user to the filter.
         ``user`` parameter is positional-only.
@@ -170,7 +209,7 @@ class UserFilter(Generic[T]):
 
         self.filtered_user.remove(user.id)
 
-    async def start(self, sink: SinkT) -> None:
+    async def start(self, sink: Union[SinkT, AudioSink]) -> None:
         """|coro|
         Start recording in the appropriate voice client.
 
@@ -178,6 +217,7 @@ class UserFilter(Generic[T]):
         -----------
         sink
             Sink is an object that records the format and the data that was transferred.
+            An :class:`AudioSink` member can be passed to use one of the built-in formats.
 
         Raises
         ------
@@ -189,19 +229,38 @@ class UserFilter(Generic[T]):
             raise AlreadyRecording(
                 "You cannot starting record because they are already recording."
             )
-        await self._empty_socket()
+        self._empty_socket()
+        # The encryption mode is fixed for the lifetime of the voice connection.
+        self._decrypt_fn = Xsalsa20Decrypt(self.voice_client.secret_key)._dispatch[
+            self.voice_client.mode
+        ]
+        self._silence_packet_size = (
+            12 + _ENCRYPTION_OVERHEAD[self.voice_client.mode] + _SILENCE_FRAME_SIZE
+        )
         self.client.dispatch("record_ready")
 
         self._decoder = DecodeManager(user_filter=self)
         await self._decoder.start()
+        self._sink = sink.value if isinstance(sink, AudioSink) else sink
+
+        self._user_audio_timestamp.clear()
+        self._loop = asyncio.get_running_loop()
+        socket = self.voice_client.socket
+        socket.setblocking(False)
+        self._socket_fd = socket.fileno()
+        try:
+            self._start_receiving()
+        except BaseException:
+            await self._decoder.stop()
+            raise
         self._recoding = True
-        self._sink = sink
 
     async def stop(self) -> RecordFileTree:
         """|coro|
 
         Stops the recording.
-        Must be already recording.
+        Must be already recording. If the recording is already being stopped,
+        this waits for that and returns the same result.
 
         Raises
         ------
@@ -213,33 +272,61 @@ class UserFilter(Generic[T]):
         :class:`RecordFileTree`
             Recorded data files file the container converts an object.
         """
-        if not self._recoding:
-            raise NotRecording("Not currently recording audio.")
+        if self._stop_task is None:
+            if not self._recoding:
+                raise NotRecording("Not currently recording audio.")
+            self._stop_task = self._loop.create_task(self._stop())
+        return await asyncio.shield(self._stop_task)
+
+    async def _stop(self) -> RecordFileTree:
+        try:
+            return await self._finish_recording()
+        finally:
+            self._stop_task = None
+
+    async def _finish_recording(self) -> RecordFileTree:
+        self._stop_receiving()
         await self._decoder.stop()
         self._recoding = False
         self._paused = False
+
+        for waiter in self._ssrc_waiters.values():
+            waiter.cancel()
+        await asyncio.gather(*self._ssrc_waiters.values(), return_exceptions=True)
+        if self._pending_audio:
+            _log.warning(
+                "Dropping audio of %d speakers that were never announced.",
+                len(self._pending_audio),
+            )
+        self._ssrc_waiters.clear()
+        self._pending_audio.clear()
+        from .tree import RecordFileTree
+
+        # Each sink call spawns its own ffmpeg process, so run them concurrently.
+        formatted_data = await asyncio.gather(
+            *(
+                self._sink.format_data(b"".join(audio_chunks))
+                for audio_chunks in self._user_audio_data.values()
+            )
+        )
         return RecordFileTree(
             files={
-                snowflake: File(
-                    fp=await self._sink.format_audio(bytes_file.raw),
-                    filename=f"audio.{self._sink.extension}",
-                )
-                for snowflake, bytes_file in self._user_audio_data.values()
+                snowflake: File(fp=fp, filename=f"audio.{self._sink.extension}")
+                for snowflake, fp in zip(self._user_audio_data, formatted_data)
             }
         )
 
-    async def unpack_audio_packet(self, data: bytes) -> None:
-        """|coro|
-
-        Takes an audio packet received from Discord and decodes it into pcm audio data.
+    def unpack_audio_packet(self, data: Union[bytes, memoryview]) -> None:
+        """Takes an audio packet received from Discord and decodes it into pcm audio data.
         If there are no users talking in the channel, `None` will be returned.
 
         You must be connected to receive audio.
 
         Parameters
         ---------
-        data: :class:`bytes`
+        data: Union[:class:`bytes`, :class:`memoryview`]
             Bytes received by Discord via the UDP connection used for sending and receiving voice data.
+            The data is copied before being queued, so the buffer may be reused afterwards.
         """
 
         if 200 <= data[1] <= 204:
@@ -250,15 +337,17 @@ class UserFilter(Generic[T]):
             return
         if self._paused:
             return
-
-        packed_data = FilteredDataPack(data=data)
-
-        if (
-            packed_data.decrypted_data(mode=self.voice_client.mode) == b"\xf8\xff\xfe"
-        ):  # Frame of silence
+        if len(data) <= self._silence_packet_size:
+            # Too small to carry more than a silence frame, so skip decrypting it.
             return
 
-    async def _empty_socket(self) -> None:
+        # Decryption and decoding are done off the event loop by the decoder.
+        try:
+            self._decoder.decode_queue.put_nowait(FilteredDataPack(data=bytes(data)))
+        except asyncio.QueueFull:
+            _log.warning("Decode queue is full, dropping voice packet.")
+
+    def _empty_socket(self) -> None:
         while True:
             ready, _w_list, _x_list = select([self.voice_client.socket], [], [], 0.0)
             if not ready:
@@ -266,88 +355,134 @@ class UserFilter(Generic[T]):
             for socket in ready:
                 socket.recv(4986)
 
-    async def _receive_packet(self) -> None:
-        self._user_audio_timestamp.clear()
+    def _start_receiving(self) -> None:
+        try:
+            self._loop.add_reader(self._socket_fd, self._on_readable)
+        except NotImplementedError:
+            # The proactor event loop used on Windows cannot watch sockets.
+            self._recv_task = self._loop.create_task(self._receive_loop())
+
+    def _stop_receiving(self) -> None:
+        if self._recv_task is not None:
+            self._recv_task.cancel()
+            self._recv_task = None
+            return
+        try:
+            self._loop.remove_reader(self._socket_fd)
+        except (ValueError, OSError):
+            # The voice client has already closed the socket.
+            pass
+
+    def _on_readable(self) -> None:
+        try:
+            size = self.voice_client.socket.recv_into(self._recv_buffer)
+        except BlockingIOError:
+            return
+        except OSError as error:
+            self._on_socket_error(error)
+            return
 
-        while self._recoding:
-            ready, _, error = select(
-                [self.voice_client.socket], [], [self.voice_client.socket], 0.01
-            )
-            if not ready and error:
-                _log.error(f"Socket error: {error}")
-            elif not ready:
-                continue
+        self.unpack_audio_packet(data=self._recv_view[:size])
 
+    async def _receive_loop(self) -> None:
+        loop = self._loop
+        socket = self.voice_client.socket
+        while True:
             try:
-                data = self.voice_client.socket.recv(4096)
-            except OSError:
-                await self.stop()
-                continue
-
-            await self.unpack_audio_packet(data=data)
-
-            for bytes_file in self._user_audio_data.values():
-                bytes_file.seek(0)
+                size = await loop.sock_recv_into(socket, self._recv_buffer)
+            except OSError as error:
+                self._on_socket_error(error)
+                return
+
+            self.unpack_audio_packet(data=self._recv_view[:size])
+
+    def _on_socket_error(self, error: OSError) -> None:
+        _log.error(f"Socket error: {error}")
+        self._stop_receiving()
+        if self._stop_task is None:
+            self._stop_task = self._loop.create_task(self._stop())
+            self._stop_task.add_done_callback(self._on_stopped_by_error)
+
+    def _on_stopped_by_error(self, task: asyncio.Task[RecordFileTree]) -> None:
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            _log.error("Failed to stop recording after a socket error", exc_info=error)
+            return
+        # The recording ended without a call to stop(), so hand it back here.
+        self.client.dispatch("record_stopped", task.result())
 
     async def receive_decoded_packet(self, packed_data: FilteredDataPack) -> None:
-        if packed_data.ssrc not in self._user_audio_timestamp:
-            self._user_audio_timestamp.update({packed_data.ssrc: packed_data.timestamp})
-            # Add silence when they were not being recorded.
+        ssrc = packed_data.ssrc
+        timestamp = packed_data.timestamp
+        user_audio_timestamp = self._user_audio_timestamp
+
+        last_timestamp = user_audio_timestamp.get(ssrc)
+        user_audio_timestamp[ssrc] = timestamp
+        if last_timestamp is None:
             silence = 0
         else:
-            silence = (
-                packed_data.timestamp
-                - self._user_audio_timestamp[packed_data.ssrc]
-                - 960
-            )
-            self._user_audio_timestamp[packed_data.ssrc] = packed_data.timestamp
+            # Add silence when they were not being recorded.
+            silence = timestamp - last_timestamp - OpusStruct.SAMPLES_PER_FRAME
+
+        ssrc_map = self.voice_websocket.ssrc_map
+        pending_chunks = self._pending_audio.get(ssrc)
+        if pending_chunks is None and ssrc in ssrc_map:
+            user_id = ssrc_map[ssrc]["user_id"]
+            user_audio_data = self._user_audio_data
+            # Chunks are joined once when the recording stops instead of
+            # growing a single buffer for every packet.
+            audio_chunks = user_audio_data.get(user_id)
+            if audio_chunks is None:
+                audio_chunks = user_audio_data[user_id] = []
+        else:
+            # The speaker has not been announced yet. Hold their audio rather
+            # than waiting here, which would stall decoding for everyone.
+            if pending_chunks is None:
+                pending_chunks = self._pending_audio[ssrc] = []
+                self._ssrc_waiters[ssrc] = self._loop.create_task(
+                    self._flush_pending_audio(ssrc)
+                )
+            audio_chunks = pending_chunks
 
-        decoded_data = struct.pack(
-            "<h", 0
-        ) * silence * OpusStruct.CHANNELS + packed_data.decrypted_data(
-            mode=self.voice_client.mode
+        if silence > 0:
+            audio_chunks.append(_SILENCE_SAMPLE * (silence * OpusStruct.CHANNELS))
+        audio_chunks.append(packed_data.decode_data)
+
+    async def _flush_pending_audio(self, ssrc: int) -> None:
+        voice_websocket = self.voice_websocket
+        await voice_websocket.wait_for_ssrc(ssrc)
+
+        del self._ssrc_waiters[ssrc]
+        user_id = voice_websocket.ssrc_map[ssrc]["user_id"]
+        self._user_audio_data.setdefault(user_id, []).extend(
+            self._pending_audio.pop(ssrc)
         )
-        while packed_data.ssrc not in getattr(self.voice_client.ws, "ssrc_map"):
-            await asyncio.sleep(0.05)
-        user_audio_data = io.BytesIO()
-        if (
-            self.voice_websocket.ssrc_map[packed_data.ssrc]["user_id"]
-            not in self._user_audio_data.keys()
-        ):
-            self._user_audio_data.update(
-                {
-                    self.voice_websocket.ssrc_map[packed_data.ssrc][
-                        "user_id"
-                    ]: user_audio_data
-                }
-            )
-            bytes_file = self._user_audio_data[
-                self.voice_websocket.ssrc_map[packed_data.ssrc]["user_id"]
-            ]
-            bytes_file.write(decoded_data)
 
 
 class FilteredDataPack:
     """Handles raw data from Discord so that it can be decrypted and decoded to be used."""
 
     def __init__(self, data: bytes) -> None:
-        self._data = bytearray(data)
-        self.xsalsa_20_decrypt = Xsalsa20Decrypt()
+        self._data = data
+        self._view = memoryview(data)
         self.user_id: Optional[Snowflake] = None
 
-        unpacker = struct.Struct(">xxHII")
-        self.sequence, self.timestamp, self.ssrc = unpacker.unpack_from(self.header)
+        self.sequence, self.timestamp, self.ssrc = _RTP_HEADER.unpack_from(
+            self._data, 0
+        )
         self.decode_data: Optional[bytes] = None
 
     @property
-    def header(self) -> bytes:
-        return self._data[:12]
+    def header(self) -> memoryview:
+        return self._view[:12]
 
     @property
-    def data(self) -> bytes:
-        return self._data[12:]
+    def data(self) -> memoryview:
+        return self._view[12:]
 
-    def decrypted_data(self, mode: str) -> Optional[bytes]:
-        return getattr(self.xsalsa_20_decrypt, f"_decrypt_{mode}")(
-            self.header, self.data
-        )
+    def decrypted_data(
+        self, decrypt_fn: Callable[[memoryview, memoryview], bytes]
+    ) -> bytes:
+        return decrypt_fn(self.header, self.data)
@@ -23,6 +23,7 @@ DEALINGS IN THE SOFTWARE.
 """
 from __future__ import annotations
 
+import asyncio
 import logging
 from discord.gateway import (
     DiscordVoiceWebSocket as OriginalDiscordVoiceWebSocket,
@@ -40,6 +41,20 @@ class DiscordVoiceWebSocket(OriginalDiscordVoiceWebSocket):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.ssrc_map: Dict[Any, Any] = {}
+        self._ssrc_events: Dict[int, asyncio.Event] = {}
+
+    async def wait_for_ssrc(self, ssrc: int) -> None:
+        """|coro|
+
+        Waits until the user using ``ssrc`` has been announced by a speaking event.
+        """
+        if ssrc in self.ssrc_map:
+            return
+
+        event = self._ssrc_events.get(ssrc)
+        if event is None:
+            event = self._ssrc_events[ssrc] = asyncio.Event()
+        await event.wait()
 
     async def received_message(self, msg: Dict[str, Any]) -> None:
         _log.debug("Voice websocket frame received: %s", msg)
@@ -74,6 +89,9 @@ class DiscordVoiceWebSocket(OriginalDiscordVoiceWebSocket):
                         }
                     }
                 )
+                event = self._ssrc_events.pop(data["ssrc"], None)
+                if event is not None:
+                    event.set()
 
         await self._hook(self, msg)
 
@@ -25,7 +25,6 @@ DEALINGS IN THE SOFTWARE.
 
 from __future__ import annotations
 
-import gc
 from typing import (
     List,
     Tuple,
@@ -41,7 +40,6 @@ from typing import (
 )
 
 import asyncio
-import array
 import ctypes
 import ctypes.util
 import logging
@@ -49,11 +47,12 @@ import math
 import os.path
 import struct
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from discord.errors import DiscordException
 
 if TYPE_CHECKING:
-    from filter import UserFilter
+    from .filter import UserFilter, FilteredDataPack
 
     T = TypeVar("T")
     BAND_CTL = Literal["narrow", "medium", "wide", "superwide", "full"]
@@ -77,6 +76,7 @@ class SignalCtl(TypedDict):
 has_nacl: bool
 
 try:
+    import nacl.exceptions  # type: ignore
     import nacl.secret  # type: ignore
     import nacl.utils  # type: ignore
 
@@ -102,6 +102,15 @@ c_float_ptr = ctypes.POINTER(ctypes.c_float)
 
 _lib: Any = None
 
+# Length field of an RTP one-byte header extension, after the 0xBEDE profile.
+_HEADER_EXT_LENGTH = struct.Struct(">xxH")
+
+# Samples per frame at 48 kHz for each opus TOC configuration (RFC 6716, 3.1):
+# SILK-only, then hybrid, then CELT-only modes.
+_TOC_SAMPLES_PER_FRAME = (
+    (480, 960, 1920, 2880) * 3 + (480, 960) * 2 + (120, 240, 480, 960) * 4
+)
+
 
 class EncoderStruct(ctypes.Structure):
     pass
@@ -263,21 +272,16 @@ def libopus_loader(name: str) -> Any:
 
     # register the functions...
     for item in exported_functions:
-        func = getattr(lib, item[0])
+        func_name, argtypes, restype, errcheck = item
+        func = getattr(lib, func_name)
 
-        try:
-            if item[1]:
-                func.argtypes = item[1]
+        if argtypes is not None:
+            func.argtypes = argtypes
 
-            func.restype = item[2]
-        except KeyError:
-            pass
+        func.restype = restype
 
-        try:
-            if item[3]:
-                func.errcheck = item[3]
-        except KeyError:
-            _log.exception("Error assigning check function to %s", func)
+        if errcheck is not None:
+            func.errcheck = errcheck
 
     return lib
 
@@ -381,11 +385,15 @@ class OpusStruct:
 
 
 class Encoder(OpusStruct):
+    MAX_PACKET_SIZE = 4000  # Recommended output buffer size from the libopus docs.
+
     def __init__(self, application: int = APPLICATION_AUDIO):
         OpusStruct.get_opus_version()
 
         self.application: int = application
         self._state: EncoderStruct = self._create_state()
+        # Reused for every encoded frame; the result is copied out of it.
+        self._data = (ctypes.c_char * self.MAX_PACKET_SIZE)()
         self.set_bitrate(128)
         self.set_fec(True)
         self.set_expected_packet_loss_percent(0.15)
@@ -411,21 +419,21 @@ class Encoder(OpusStruct):
         return kbps
 
     def set_bandwidth(self, req: BAND_CTL) -> None:
-        if req not in band_ctl:
+        k = band_ctl.get(req)
+        if k is None:
             raise KeyError(
                 f'{req!r} is not a valid bandwidth setting. Try one of: {",".join(band_ctl)}'
             )
 
-        k = band_ctl[req]
         _lib.opus_encoder_ctl(self._state, CTL_SET_BANDWIDTH, k)
 
     def set_signal_type(self, req: SIGNAL_CTL) -> None:
-        if req not in signal_ctl:
+        k = signal_ctl.get(req)
+        if k is None:
             raise KeyError(
                 f'{req!r} is not a valid bandwidth setting. Try one of: {",".join(signal_ctl)}'
             )
 
-        k = signal_ctl[req]
         _lib.opus_encoder_ctl(self._state, CTL_SET_SIGNAL, k)
 
     def set_fec(self, enabled: bool = True) -> None:
@@ -437,21 +445,26 @@ class Encoder(OpusStruct):
         )
 
     def encode(self, pcm: bytes, frame_size: int) -> bytes:
-        max_data_bytes = len(pcm)
         # bytes can be used to reference pointer
         pcm_ptr = ctypes.cast(pcm, c_int16_ptr)  # type: ignore
-        data = (ctypes.c_char * max_data_bytes)()
+        data = self._data
 
-        ret = _lib.opus_encode(self._state, pcm_ptr, frame_size, data, max_data_bytes)
+        ret = _lib.opus_encode(
+            self._state, pcm_ptr, frame_size, data, self.MAX_PACKET_SIZE
+        )
 
-        return array.array("b", data[:ret]).tobytes()
+        return ctypes.string_at(data, ret)
 
 
 class Decoder(OpusStruct):
+    MAX_FRAME_SIZE = 5760  # 120 ms at 48 kHz, the longest an opus packet can be.
+
     def __init__(self):
         OpusStruct.get_opus_version()
 
         self._state: DecoderStruct = self._create_state()
+        # Reused for every decoded packet, sized for the longest possible packet.
+        self._pcm = (ctypes.c_int16 * (self.MAX_FRAME_SIZE * self.CHANNELS))()
 
     def __del__(self) -> None:
         if hasattr(self, "_state"):
@@ -517,102 +530,215 @@ class Decoder(OpusStruct):
         ...
 
     def decode(self, data: Optional[bytes], *, fec: bool = False) -> bytes:
+        ret = self._decode(data, self._pcm, self.MAX_FRAME_SIZE, fec)
+        return ctypes.string_at(self._pcm, ret * self.SAMPLE_SIZE)
+
+    def decode_into(
+        self, data: Optional[bytes], out: memoryview, *, fec: bool = False
+    ) -> int:
+        """Decodes a packet straight into a writable buffer instead of new bytes.
+
+        Returns the number of samples per channel written to ``out``.
+        """
+        max_frame_size = memoryview(out).nbytes // self.SAMPLE_SIZE
+        pcm = (ctypes.c_int16 * (max_frame_size * self.CHANNELS)).from_buffer(out)
+        return self._decode(data, pcm, max_frame_size, fec)
+
+    def _decode(
+        self, data: Optional[bytes], pcm: Any, max_frame_size: int, fec: bool
+    ) -> int:
         if data is None and fec:
             raise TypeError("Invalid arguments: FEC cannot be used with null data")
 
         if data is None:
             frame_size = self._get_last_packet_duration() or self.SAMPLES_PER_FRAME
-            channel_count = self.CHANNELS
+        elif data and data[0] & 0x03 != 3:
+            # Frame count codes 0 to 2 mean one frame or two frames of the same
+            # duration, so the size can be read from the TOC byte directly.
+            toc = data[0]
+            frame_size = _TOC_SAMPLES_PER_FRAME[toc >> 3] * (2 if toc & 0x03 else 1)
         else:
             frames = self.packet_get_nb_frames(data)
-            channel_count = self.packet_get_nb_channels(data)
             samples_per_frame = self.packet_get_samples_per_frame(data)
             frame_size = frames * samples_per_frame
 
-        pcm = (ctypes.c_int16 * (frame_size * channel_count))()
-        pcm_ptr = ctypes.cast(pcm, c_int16_ptr)
-
-        ret = _lib.opus_decode(
-            self._state, data, len(data) if data else 0, pcm_ptr, frame_size, fec
+        # The decoder always outputs self.CHANNELS channels, whatever the
+        # channel count of the packet is.
+        return _lib.opus_decode(
+            self._state,
+            data,
+            len(data) if data else 0,
+            pcm,
+            min(frame_size, max_frame_size),
+            fec,
         )
 
-        return array.array("h", pcm[: ret * channel_count]).tobytes()
-
 
 class Xsalsa20Decrypt:
-    secret_key: List[int]
+    secret_key: bytes
+
+    def __init__(self, secret_key: List[int]) -> None:
+        # Discord sends the key as a list of ints; convert it once here.
+        self.secret_key = bytes(secret_key)
+        # The key is fixed for the voice connection, so one box serves every packet.
+        self._box = nacl.secret.SecretBox(self.secret_key)
+        self._dispatch: Dict[str, Callable[[Any, Any], bytes]] = {
+            "xsalsa20_poly1305": self._decrypt_xsalsa20_poly1305,
+            "xsalsa20_poly1305_suffix": self._decrypt_xsalsa20_poly1305_suffix,
+            "xsalsa20_poly1305_lite": self._decrypt_xsalsa20_poly1305_lite,
+        }
 
     @staticmethod
     def strip_header_ext(data):
         if data[0] == 0xBE and data[1] == 0xDE and len(data) > 4:
-            _, length = struct.unpack_from(">HH", data)
+            (length,) = _HEADER_EXT_LENGTH.unpack_from(data)
             offset = 4 + length * 4
             data = data[offset:]
         return data
 
     def _decrypt_xsalsa20_poly1305(self, header, data):
-        box = nacl.secret.SecretBox(bytes(self.secret_key))
+        box = self._box
 
-        nonce = bytearray(24)
-        nonce[:12] = header
+        # PyNaCl only accepts bytes, so this is the one copy made of the payload.
+        nonce = bytes(header) + bytes(12)
 
-        return self.strip_header_ext(box.decrypt(bytes(data), bytes(nonce)))
+        return self.strip_header_ext(box.decrypt(bytes(data), nonce))
 
     def _decrypt_xsalsa20_poly1305_suffix(self, _header, data):
-        box = nacl.secret.SecretBox(bytes(self.secret_key))
+        box = self._box
 
         nonce_size = nacl.secret.SecretBox.NONCE_SIZE
-        nonce = data[-nonce_size:]
+        nonce = bytes(data[-nonce_size:])
 
         return self.strip_header_ext(box.decrypt(bytes(data[:-nonce_size]), nonce))
 
     def _decrypt_xsalsa20_poly1305_lite(self, _header, data):
-        box = nacl.secret.SecretBox(bytes(self.secret_key))
+        box = self._box
 
-        nonce = bytearray(24)
-        nonce[:4] = data[-4:]
-        data = data[:-4]
+        nonce = bytes(data[-4:]) + bytes(20)
 
-        return self.strip_header_ext(box.decrypt(bytes(data), bytes(nonce)))
+        return self.strip_header_ext(box.decrypt(bytes(data[:-4]), nonce))
 
 
 class DecodeManager(OpusStruct):
     def __init__(self, user_filter: UserFilter) -> None:
         self.user_filter = user_filter
-        self.decode_queue: list = []
-
-        self._decoder: Dict[bytes, Decoder] = {}
-        self._end_thread: asyncio.Event = asyncio.Event()
-
-    def _get_decoder(self, ssrc: bytes) -> Decoder:
-        if not self._decoder.get(ssrc):
-            self._decoder[ssrc] = Decoder()
-        return self._decoder[ssrc]
+        # Created in start() so that it is bound to the running event loop.
+        self.decode_queue: Optional[asyncio.Queue[FilteredDataPack]] = None
+
+        self._decoder: Dict[int, Decoder] = {}
+        self._task: Optional[asyncio.Task] = None
+        # libsodium and libopus both release the GIL, so decrypting and decoding
+        # in worker threads keeps the event loop free while packets are processed.
+        self._executor = ThreadPoolExecutor(
+            max_workers=min(4, os.cpu_count() or 1),
+            thread_name_prefix="voice_record-decode",
+        )
 
-    async def start(self) -> None:
-        while not self._end_thread.is_set():
+    def _get_decoder(self, ssrc: int) -> Decoder:
+        decoder = self._decoder.get(ssrc)
+        if decoder is None:
+            # setdefault is atomic, so worker threads can never end up using
+            # two different decoders for the same speaker.
+            decoder = self._decoder.setdefault(ssrc, Decoder())
+        return decoder
+
+    def _decrypt_and_decode_batch(
+        self, batch: List[FilteredDataPack]
+    ) -> List[FilteredDataPack]:
+        # Every packet in a batch comes from the same speaker, so the decoder
+        # and decrypt function are looked up once for the whole batch.
+        decode = self._get_decoder(batch[0].ssrc).decode
+        decrypt_fn = self.user_filter._decrypt_fn
+
+        decoded = []
+        for data in batch:
             try:
-                data = self.decode_queue.pop(0)
-            except IndexError:
+                decrypted_data = data.decrypted_data(decrypt_fn)
+            except nacl.exceptions.CryptoError as error:
+                # A single corrupt datagram must not end the recording.
+                _log.error(f"Error occurred while decrypting voice packet: {error}")
+                continue
+
+            if decrypted_data == b"\xf8\xff\xfe":  # Frame of silence
                 continue
 
             try:
-                if data.decrypted_data is None:
-                    continue
-                else:
-                    data.decrypted_data = self._get_decoder(data.ssrc).decode(
-                        data.decrypted_data
-                    )
+                data.decode_data = decode(decrypted_data)
             except OpusError as error:
                 _log.error(f"Error occurred while decoding opus frame: {error}")
                 continue
 
-            await self.user_filter.receive_decoded_packet(data)
+            decoded.append(data)
+        return decoded
+
+    async def _process_batch(self, batch: List[FilteredDataPack]) -> None:
+        loop = asyncio.get_running_loop()
+
+        # Speakers are decoded in parallel, but all packets of one speaker
+        # go to the same job so its Decoder is used by one thread, in order.
+        by_ssrc: Dict[int, List[FilteredDataPack]] = {}
+        for data in batch:
+            packets = by_ssrc.get(data.ssrc)
+            if packets is None:
+                by_ssrc[data.ssrc] = [data]
+            else:
+                packets.append(data)
+
+        results = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    self._executor, self._decrypt_and_decode_batch, packets
+                )
+                for packets in by_ssrc.values()
+            )
+        )
+
+        for decoded in results:
+            for data in decoded:
+                await self.user_filter.receive_decoded_packet(data)
+
+    async def start(self) -> None:
+        self.decode_queue = asyncio.Queue(maxsize=256)
+        self._task = asyncio.get_running_loop().create_task(self._consume())
+
+    async def _consume(self) -> None:
+        queue = self.decode_queue
+        while True:
+            # Hand every queued packet to the worker at once so the thread
+            # hand-off is paid once per batch rather than once per packet.
+            batch = [await queue.get()]
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+
+            try:
+                await self._process_batch(batch)
+            except Exception:
+                # Keep consuming, otherwise the queue fills up and every
+                # later packet is dropped until the recording stops.
+                _log.exception("Error occurred while processing voice packets")
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        # Wait until every queued packet has been decoded and handed over,
+        # unless the consumer has died or cannot catch up in time.
+        join = asyncio.ensure_future(self.decode_queue.join())
+        done, _pending = await asyncio.wait(
+            {join, self._task}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        if join not in done:
+            join.cancel()
+            _log.warning(
+                "Decode queue was not drained before stopping, %d packets left.",
+                self.decode_queue.qsize(),
+            )
 
-    async def stop(self) -> None:
-        while bool(self.decode_queue):
-            await asyncio.sleep(0.1)
-            self._decoder.clear()
-            gc.collect()
-            _log.info("Decoder Process Killed")
-        self._end_thread.set()
+        self._task.cancel()
+        (result,) = await asyncio.gather(self._task, return_exceptions=True)
+        if isinstance(result, Exception):
+            _log.error(f"Decoder Process crashed: {result!r}")
+        self._executor.shutdown(wait=False)
+        self._decoder.clear()
+        _log.info("Decoder Process Killed")
@@ -30,7 +30,7 @@ from io import BytesIO
 from sys import platform
 from subprocess import PIPE
 from os import urandom, path, remove
-from asyncio import create_subprocess_exec
+from asyncio import create_subprocess_exec, get_running_loop
 
 if TYPE_CHECKING:
     pass
@@ -44,27 +44,35 @@ else:
     CREATE_NO_WINDOW = 0x08000000
 
 
+# Input is always 48 kHz stereo signed 16-bit PCM read from stdin.
+_FFMPEG_PREFIX = (
+    "ffmpeg",
+    "-hide_banner",
+    "-loglevel",
+    "error",
+    "-f",
+    "s16le",
+    "-ar",
+    "48000",
+    "-ac",
+    "2",
+    "-i",
+    "-",
+    "-f",
+)
+
+
 def _create_ffmpeg_argument(
     file_type: str, /, save_file: bool = False, file_name: str = None
 ) -> list:
-    default_arguments = [
-        "ffmpeg",
-        "-f",
-        "s16le",
-        "-ar",
-        "48000",
-        "-ac",
-        "2",
-        "-i",
-        "-",
-        "-f",
-        file_type,
-    ]
-    if not save_file:
-        default_arguments.append("pipe:1")
-    else:
-        default_arguments.append(file_name)
-    return default_arguments
+    return [*_FFMPEG_PREFIX, file_type, file_name if save_file else "pipe:1"]
+
+
+def _read_and_remove(file_name: str, /) -> bytes:
+    with open(file_name, "rb") as file:
+        data = file.read()
+    remove(file_name)
+    return data
 
 
 class BaseSink(metaclass=ABCMeta):
@@ -90,7 +98,12 @@ class BaseSink(metaclass=ABCMeta):
 
 
 class FFMPEGBaseSink(BaseSink):
-    """A base sink for formatting data using ffmpeg."""
+    """A base sink for formatting data using ffmpeg.
+
+    ``save_temporary_file`` is only needed for container formats that ffmpeg
+    cannot write to a non-seekable pipe, such as mp4. Other formats are read
+    straight from ffmpeg's stdout.
+    """
 
     def __init__(self, file_type: str, save_temporary_file: bool = False, **kwargs):
         super().__init__(**kwargs)
@@ -105,6 +118,18 @@ class FFMPEGBaseSink(BaseSink):
 
         If the new object has a parent class as this object, that method must be used.
 
+        Parameters
+        -----------
+        raw_data: :class:`bytes`
+            Recorded raw data.
+        """
+        return BytesIO(await self.format_data_bytes(raw_data))
+
+    async def format_data_bytes(self, raw_data: bytes) -> bytes:
+        """|coro|
+
+        Formats the recorded data and returns the output of ffmpeg as is.
+
         Parameters
         -----------
         raw_data: :class:`bytes`
@@ -130,9 +155,9 @@ class FFMPEGBaseSink(BaseSink):
         stdout, _stderr = await process.communicate(input=raw_data)
 
         if self.save_temporary_file:
-            with open(temporary_file_name, "rb") as temporary_file:
-                stdout = temporary_file.read()
+            # Reading a whole recording back can take a while, keep it off the loop.
+            stdout = await get_running_loop().run_in_executor(
+                None, _read_and_remove, temporary_file_name
+            )
 
-        formatted_data = BytesIO(stdout)
-        formatted_data.seek(0)
-        return formatted_data
+        return stdout
@@ -51,6 +51,8 @@ class VoiceFilterTree(Generic[ClientT]):
         The client instance to use for the recording client.
     """
 
+    __slots__ = ("client", "_user_filters")
+
     def __init__(self, client: ClientT) -> None:
         self.client: ClientT = client
         self._user_filters: Dict[int, UserFilter] = {}
@@ -110,6 +112,8 @@ class RecordFileTree:
         File data from the user audio recording.
     """
 
+    __slots__ = ("_files",)
+
     def __init__(self, files: Dict[Snowflake, File]) -> None:
         self._files: Dict[Snowflake, File] = files
 
@@ -119,7 +123,7 @@ class RecordFileTree:
     def all(self) -> Optional[List[File]]:
         """Returns data from all files."""
 
-        return self._files.values() or None
+        return list(self._files.values()) if self._files else None
 
     def get(self, id: int, /) -> Optional[File]:
         """Returns a recorded file for a specific user.